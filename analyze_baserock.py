@@ -34,9 +34,16 @@ git clone git://git.baserock.org/baserock/baserock/definitions.git baserock-defi
 """
 
 import argparse
+import json
 import logging
+import os
 import yaml
 import subprocess
+try:
+    # Use libyaml-based loader, if available
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 def parse_args ():
     """
@@ -55,6 +62,89 @@ def parse_args ():
     args = parser.parse_args()
     return args
 
+def load_strata (strata_file):
+    """Load a strata file.
+
+    The parsed strata is cached as JSON, in a file alongside the strata
+    file, which is used instead of parsing again the strata file,
+    unless the latter is newer.
+
+    :param strata_file: Name of the strata file (YAML)
+    :returns:           Parsed strata
+
+    """
+
+    cache_file = strata_file + '.cache.json'
+    if os.path.exists(cache_file) \
+        and os.stat(cache_file).st_mtime >= os.stat(strata_file).st_mtime:
+        logging.debug('Reading strata cache file: %s', cache_file)
+        try:
+            with open(cache_file, 'r') as cache_fp:
+                return json.load(cache_fp)
+        except (OSError, ValueError) as e:
+            # Cache could not be read, just parse the strata file
+            logging.info('Could not read strata cache file: %s', e)
+    logging.debug('Reading strata file: %s', strata_file)
+    with open(strata_file, 'r') as strata_fp:
+        strata = yaml.load(strata_fp, Loader=SafeLoader)
+    # Write to a temporary file, and rename it when done, so that
+    # the cache is never left half-written
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as cache_fp:
+            json.dump(strata, cache_fp)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError) as e:
+        # Cache could not be written, just go on without it
+        logging.info('Could not write strata cache file: %s', e)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return strata
+
+def run_cmd (cmd):
+    """Run a command, logging it.
+
+    :param cmd: Command to run (list)
+    :returns:   Return code of the command
+
+    """
+
+    logging.debug('Running %s', ' '.join(cmd))
+    return subprocess.call(cmd)
+
+def clone_ref (repo_url, repo_ref, repo_dir):
+    """Clone only the snapshot for a ref of a git repository.
+
+    Fetch only the commit for ref (branch, tag, or commit hash), with
+    depth 1, and check it out. If that is not possible (eg, the server
+    does not allow fetching commits by hash, or ref is an abbreviated
+    hash), fetch the whole repository and check out ref. If the
+    directory is already a git repository, it is reused.
+
+    :param repo_url: Url of the git repository
+    :param repo_ref: Ref (branch, tag, or commit hash) to check out
+    :param repo_dir: Directory for the clone
+    :returns:        Return code of the last command run
+
+    """
+
+    git_dir = os.path.join(repo_dir, '.git')
+    if os.path.isdir(git_dir):
+        run_cmd(['git', '-C', repo_dir, 'remote', 'set-url', 'origin', repo_url])
+    else:
+        run_cmd(['git', 'init', repo_dir])
+        run_cmd(['git', '-C', repo_dir, 'remote', 'add', 'origin', repo_url])
+    if run_cmd(['git', '-C', repo_dir, 'fetch', '--depth', '1',
+                'origin', repo_ref]) == 0:
+        return run_cmd(['git', '-C', repo_dir, 'checkout', 'FETCH_HEAD'])
+    logging.info('Could not fetch only %s, fetching all', repo_ref)
+    fetch_cmd = ['git', '-C', repo_dir, 'fetch', '--tags', 'origin']
+    if os.path.exists(os.path.join(git_dir, 'shallow')):
+        # Some previous fetch was shallow, get the complete history
+        fetch_cmd.insert(4, '--unshallow')
+    run_cmd(fetch_cmd)
+    return run_cmd(['git', '-C', repo_dir, 'checkout', repo_ref])
 
 if __name__ == "__main__":
 
@@ -72,25 +162,20 @@ if __name__ == "__main__":
             logging.basicConfig(format=log_format, level=level)
     strata_template = 'baserock-definitions/strata/%s.morph'
     strata_file = strata_template % args.strata
-    logging.debug('Reading strata file: ' + strata_file)
-    with open(strata_file, 'r') as strata_fp:
-        strata = yaml.safe_load(strata_fp)
-    for chunk in strata['chunks']:
-        if args.pkg == chunk['name']:
-            pkg_data = chunk
-    logging.debug('Info about pkg: ' + str(pkg_data))
+    strata = load_strata(strata_file)
+    pkg_data = next((chunk for chunk in strata['chunks']
+                        if chunk['name'] == args.pkg), None)
+    if pkg_data is None:
+        logging.error('Package not found in strata: %s', args.pkg)
+        exit(1)
+    logging.debug('Info about pkg: %s', pkg_data)
     repo_name = pkg_data['repo']
     if repo_name == 'upstream:git':
         repo_url = 'http://git.baserock.org/cgit/delta/' \
             + repo_name.replace('upstream:', '', 1) + '.git'
         repo_ref = pkg_data['ref']
-        logging.info('Repo: ' + repo_name + ', ' + repo_url + ', ' + repo_ref)
+        logging.info('Repo: %s, %s, %s', repo_name, repo_url, repo_ref)
         repo_dir = 'baserock:' + repo_name
-        git_clone_cmd = ['git', 'clone', repo_url, repo_dir]
-        logging.debug('Running ' + ' '.join(git_clone_cmd))
-        subprocess.call(git_clone_cmd)
-        git_ckeckout_cmd = ['git', '-C', repo_dir, 'checkout', repo_ref]
-        logging.debug('Running ' + ' '.join(git_ckeckout_cmd))
-        subprocess.call(git_ckeckout_cmd)
+        clone_ref(repo_url, repo_ref, repo_dir)
     else:
-        logging.info('Repo: ' + repo_name)
+        logging.info('Repo: %s', repo_name)
@@ -31,6 +31,7 @@ diff_test.py --repo git.repo -p git-2.7.0 --after 2016-02-01 --step 10 -l info
 """
 
 import argparse
+import concurrent.futures
 import filecmp
 import difflib
 import os
@@ -43,6 +44,15 @@ import subprocess
 import logging
 import io
 import datetime
+import hashlib
+import multiprocessing
+
+# Digests of file contents, keyed by file name. Values are tuples
+# (inode, modification time, size, digest), so that the digest is computed
+# again only if the file changed (eg, after a checkout)
+_digests = {}
+# Results of compare_files, keyed by the digests of the files compared
+_comparisons = {}
 
 def parse_args ():
     """
@@ -68,6 +78,8 @@ def parse_args ():
                         help = "Log file")
     parser.add_argument("--step", type=int, default=1,
                         help = "Step (compare every step commits, instead of all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help = "Number of commits to compare in parallel, each in its own git worktree (default: 1)")
     args = parser.parse_args()
     return args
 
@@ -163,6 +175,27 @@ def extract_dpkg(dpkg):
         exit()
     return dir
 
+def count_lines(name):
+    """Count lines in a file.
+
+    Newlines are counted in the raw contents of the file, which is read
+    in large blocks. A last line with no newline is counted too.
+
+    :params name: file name
+    :returns: number of lines
+
+    """
+
+    lines = 0
+    last = b'\n'
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1
+    return lines
+
 def count_unique(dir, files):
     """Count unique files.
 
@@ -180,36 +213,90 @@ def count_unique(dir, files):
     for file in files:
         name = os.path.join(dir, file)
         if os.path.isfile(name):
-            num_lines += sum(1 for line in open(name, encoding="ascii",
-                                                errors="surrogateescape"))
+            num_lines += count_lines(name)
             logging.debug("Unique file: %s (lines: %d)" % (name, num_lines))
     logging.debug ("Unique files in dir %s: files: %d, lines: %d"
         % (dir, num_files, num_lines))
     return (num_files, num_lines)
 
+def file_digest(name):
+    """Get the digest of the contents of a file.
+
+    Digests are cached, and computed again only if the file changed.
+    If the file had to be read to compute the digest, its contents
+    are returned too, so that it doesn't need to be read again.
+
+    :params name: file name
+    :returns: tuple with digest (bytes), and contents (bytes, or None if
+        the digest was cached)
+
+    """
+
+    stat = os.stat(name)
+    cached = _digests.get(name)
+    if cached is not None \
+        and cached[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+        return (cached[3], None)
+    with open(name, 'rb') as f:
+        data = f.read()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    _digests[name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size, digest)
+    return (digest, data)
+
+def read_lines(name, data = None):
+    """Read the lines of a file, as text (ascii, with surrogate escapes).
+
+    :params name: file name
+    :params data: contents of the file, if already read (default: None)
+    :returns: list of lines, with universal newlines
+
+    """
+
+    if data is None:
+        with open(name, 'rb') as f:
+            data = f.read()
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="ascii",
+                            errors="surrogateescape")
+    return text.readlines()
+
 def compare_files(file_left, file_right):
     """Compare two files.
 
+    Results are cached by the contents of the files, so that the same pair
+    of contents is not compared again (eg, for files not changed between
+    the commits being compared). Files with the same contents (same size
+    and digest) are not diffed, and each file is read at most once.
+    Lines added and removed are those reported by difflib.ndiff.
+
     :params file_left: left file to compare
     :params file_right: left file to compare
     :returns: tuple with 1 (if different), 0 (if equal), lines added, removed
 
     """
 
+    (digest_left, data_left) = file_digest(file_left)
+    (digest_right, data_right) = file_digest(file_right)
+    key = (digest_left, digest_right)
+    if digest_left == digest_right:
+        return (0, 0, 0)
+    if key in _comparisons:
+        return _comparisons[key]
     added = 0
     removed = 0
-    with open(file_left,'r', encoding="ascii", errors="surrogateescape") as left, \
-        open(file_right,'r', encoding="ascii", errors="surrogateescape") as right:
-        diff = difflib.ndiff(left.readlines(), right.readlines())
-        for line in diff:
-            if line.startswith('+'):
-                added += 1
-            elif line.startswith('-'):
-                removed += 1
+    # ndiff (with its line junk heuristics) defines the metric: other
+    # matchers may align lines differently, and produce different counts
+    diff = difflib.ndiff(read_lines(file_left, data_left),
+                        read_lines(file_right, data_right))
+    for line in diff:
+        if line.startswith('+'):
+            added += 1
+        elif line.startswith('-'):
+            removed += 1
     if (added + removed) > 0:
         diff = 1
     else:
         diff = 0
+    _comparisons[key] = (diff, added, removed)
     return (diff, added, removed)
 
 def count_common(dir_left, dir_right, files):
@@ -237,8 +324,50 @@ def count_common(dir_left, dir_right, files):
         removed += removed_l
     return (diff_files, added, removed)
 
+class Dirs_Comparison:
+    """Comparison of the contents of two directories.
+
+    Drop-in replacement for filecmp.dircmp, providing only the attributes
+    used by compare_dirs (left, right, left_only, right_only, common_files,
+    subdirs), and classifying entries in the same way (with the same
+    names ignored). Directories are read with os.scandir, so that the
+    type of each entry is usually known without calling stat.
+
+    :params left: left directory to compare
+    :params right: right directory to compare
+    :params ignore: names to ignore (default: filecmp.DEFAULT_IGNORES)
+
+    """
+
+    def __init__(self, left, right, ignore = None):
+
+        if ignore is None:
+            ignore = filecmp.DEFAULT_IGNORES
+        self.left = left
+        self.right = right
+        with os.scandir(left) as entries:
+            left_entries = {entry.name: entry for entry in entries
+                            if entry.name not in ignore}
+        with os.scandir(right) as entries:
+            right_entries = {entry.name: entry for entry in entries
+                            if entry.name not in ignore}
+        self.left_only = sorted(left_entries.keys() - right_entries.keys())
+        self.right_only = sorted(right_entries.keys() - left_entries.keys())
+        self.common_files = []
+        self.subdirs = {}
+        for name in sorted(left_entries.keys() & right_entries.keys()):
+            left_entry = left_entries[name]
+            right_entry = right_entries[name]
+            # Both follow symlinks, and are False if stat fails, as
+            # with dircmp (other combinations are "funny", and ignored)
+            if left_entry.is_dir() and right_entry.is_dir():
+                self.subdirs[name] = Dirs_Comparison(left_entry.path,
+                                                    right_entry.path, ignore)
+            elif left_entry.is_file() and right_entry.is_file():
+                self.common_files.append(name)
+
 def compare_dirs(dcmp):
-    """Compare two directories given their filecmp.dircmp object.
+    """Compare two directories given their Dirs_Comparison object.
 
     Produces as a result a dictionary with metrcis about the comparison:
      * left_files: number of files unique in left directory
@@ -251,7 +380,8 @@ def compare_dirs(dcmp):
 
     added_lines, removed_lines refer only to files counted as diff_files
 
-    :params dcmp: filecmp.dircmp object for directories to compare
+    :params dcmp: Dirs_Comparison (or filecmp.dircmp) object for directories
+        to compare
     :returns: dictionary with differences
 
     """
@@ -269,21 +399,89 @@ def compare_dirs(dcmp):
             m[metric] += value
     return m
 
+def checkout_metrics(repo, dir, commit):
+    """Check out commit in repo, and compare it with dir.
+
+    :params repo: git repository (or worktree) to check out
+    :params dir: directory to compare with
+    :params commit: hash of the commit to check out
+    :returns: dictionary with metrics, as produced by compare_dirs
+
+    """
+
+    subprocess.call(["git", "-C", repo, "checkout", commit],
+                    stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    dcmp = Dirs_Comparison(repo, dir)
+    return compare_dirs(dcmp)
+
+def tree_ids(repo, commits):
+    """Get the hashes of the trees for a list of commits.
+
+    :params repo: git repository
+    :params commits: list of commit hashes
+    :returns: list of tree hashes, in the same order
+
+    """
+
+    # Revisions are passed on stdin, since there may be too many of them
+    # for the command line
+    revisions = "".join(commit + "^{tree}\n" for commit in commits)
+    output = subprocess.run(["git", "-C", repo, "cat-file",
+                            "--batch-check=%(objectname)"],
+                            input=revisions.encode("ascii"),
+                            stdout=subprocess.PIPE, check=True).stdout
+    trees = output.decode("ascii").splitlines()
+    for tree in trees:
+        if tree.endswith(" missing"):
+            raise ValueError("Cannot find tree for " + tree.split()[0])
+    return trees
+
+# Worktree used by the current worker process (see Metrics.compute_range)
+_worktree = None
+
+def _init_worker(worktrees):
+    """Initialize a worker process, making it own one of the worktrees.
+
+    :params worktrees: queue with the worktrees not yet owned by a worker
+
+    """
+
+    global _worktree
+    _worktree = worktrees.get()
+
+def _worker_metrics(params):
+    """Compute metrics for a commit in a worker process.
+
+    :params params: tuple (directory to compare, commit hash)
+    :returns: dictionary with metrics, as produced by compare_dirs
+
+    """
+
+    (dir, commit) = params
+    return checkout_metrics(_worktree, dir, commit)
 
 class Metrics:
     """Data structure for dealing with metrics related to commits.
 
     """
 
-    def __init__(self, repo, dir):
+    def __init__(self, repo, dir, jobs = 1):
 
-        # List of commit hashes, ordered as returned by git
+        # List of commits, as (hash, date) tuples, ordered as returned by git
         self.commits = []
         # Dictionary with metrics, key is the commit number (order in commits)
         self.metrics = {}
+        # Dictionary with metrics produced by compare_dirs, key is the
+        # tree hash (commits with the same tree share them)
+        self.trees = {}
         # Repository and directory to compare
         self.repo = repo
         self.dir = dir
+        # Number of commits to compare in parallel, and (if more than one)
+        # pool of worker processes, and temporary directory for worktrees
+        self.jobs = jobs
+        self.pool = None
+        self.worktrees_dir = None
 
     def add_commit(self, commit, date):
         """Add commit info to data structure.
@@ -293,7 +491,7 @@ class Metrics:
 
         """
 
-        self.commits.append([commit, date])
+        self.commits.append((commit, date))
 
     def get_commit(self, seq_no):
         """Get a commit tuple (hash, date) for a given commit sequence.
@@ -309,25 +507,22 @@ class Metrics:
 
         return len(self.commits)
 
-    def compute_metrics(self, commit_no):
-        """Compute metrics for commmit number (ordered as from git log).
+    def add_totals(self, m, commit_no):
+        """Add totals, and commit information, to metrics for a commit.
 
-        Checks out the corresponding commit in the git repository, and
-        compute the metrics for its difference with the given package.
         The returned metrics are those produced by compare_dirs plus:
+         * total_files, total_lines: totals of files and lines
+         * commit_seq: commit number
          * commit: hash for the commit
          * date: commit date for the commit (as a string)
 
-        :params commits: list of all commits
-        :params commmit_no: commit number (starting in 0)
+        :params m: dictionary with metrics, as produced by compare_dirs
+        :params commit_no: commit number (starting in 0)
         :returns: dictionary with metrics
+
         """
 
         commit = self.commits[commit_no]
-        subprocess.call(["git", "-C", self.repo, "checkout", commit[0]],
-                        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-        dcmp = filecmp.dircmp(self.repo, self.dir)
-        m = compare_dirs(dcmp)
         logging.debug ("Commit %s. Files: %d, %d, %d, lines: %d, %d, %d, %d)"
             % (commit[0], m["left_files"], m["right_files"], m["diff_files"],
             m["left_lines"], m["right_lines"],
@@ -353,12 +548,72 @@ class Metrics:
 
         """
 
-        for seq_no in list(range(first, last, step)) + [last]:
-            logging.info("Computing metrics for %d." % seq_no)
-            if seq_no not in self.metrics:
-                m = self.compute_metrics(seq_no)
-                logging.info(m)
-                self.metrics[seq_no] = m
+        seq_nos = [seq_no for seq_no in list(range(first, last, step)) + [last]
+                    if seq_no not in self.metrics]
+        if len(seq_nos) == 0:
+            return
+        # Commits with the same tree have the same metrics: compare
+        # only one commit per tree not compared yet
+        trees = dict(zip(seq_nos, tree_ids(self.repo,
+                            [self.commits[seq_no][0] for seq_no in seq_nos])))
+        to_compare = {}
+        for seq_no in seq_nos:
+            tree = trees[seq_no]
+            if tree not in self.trees and tree not in to_compare:
+                to_compare[tree] = self.commits[seq_no][0]
+        if self.jobs > 1 and len(to_compare) > 0:
+            pool = self.get_pool()
+            params = [(self.dir, commit) for commit in to_compare.values()]
+            for tree, m in zip(to_compare, pool.map(_worker_metrics, params)):
+                self.trees[tree] = m
+        else:
+            for tree, commit in to_compare.items():
+                logging.info("Computing metrics for %s." % commit)
+                self.trees[tree] = checkout_metrics(self.repo, self.dir, commit)
+        for seq_no in seq_nos:
+            m = self.add_totals(dict(self.trees[trees[seq_no]]), seq_no)
+            logging.info(m)
+            self.metrics[seq_no] = m
+
+    def get_pool (self):
+        """Get the pool of worker processes, creating it if needed.
+
+        Each worker owns a git worktree of the repository, created in a
+        temporary directory, so that checkouts in different workers don't
+        collide. Files not tracked by git are not present in worktrees.
+
+        :returns: concurrent.futures.ProcessPoolExecutor object
+
+        """
+
+        if self.pool is None:
+            self.worktrees_dir = tempfile.TemporaryDirectory()
+            worktrees = multiprocessing.Queue()
+            for job in range(self.jobs):
+                worktree = os.path.join(self.worktrees_dir.name, str(job))
+                subprocess.check_call(["git", "-C", self.repo, "worktree", "add",
+                                        "--detach", worktree],
+                                    stdout = subprocess.DEVNULL,
+                                    stderr = subprocess.DEVNULL)
+                worktrees.put(worktree)
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers = self.jobs,
+                initializer = _init_worker, initargs = (worktrees,))
+        return self.pool
+
+    def close (self):
+        """Shut down the pool of worker processes, removing their worktrees.
+
+        """
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.worktrees_dir.cleanup()
+            self.worktrees_dir = None
+            subprocess.call(["git", "-C", self.repo, "worktree", "prune"],
+                            stdout = subprocess.DEVNULL,
+                            stderr = subprocess.DEVNULL)
 
     def min_range (self, length, metric):
         """Find range of minimum values.
@@ -420,7 +675,7 @@ class Metrics:
         return [self.metrics[seq_no] for seq_no in sorted(self.metrics)]
         #return self.metrics.values()
 
-def find_upstream_commit (upstream, dir, after):
+def find_upstream_commit (upstream, dir, after, step = 1, jobs = 1):
     """Find the most likely upstream commit.
 
     Compares a source code directory with the checkouts from its upstream
@@ -435,26 +690,30 @@ def find_upstream_commit (upstream, dir, after):
     :params upstream: upstream git repository
     :params dir: source code directory to match to upstream
     :params after: check only commits after this date, format: %Y-%m-%d
+    :params step: initial step (compare every step commits, instead of all)
+    :params jobs: number of commits to compare in parallel
     :returns:
 
     """
 
-    metrics = Metrics(repo=upstream, dir=dir)
+    metrics = Metrics(repo=upstream, dir=dir, jobs=jobs)
     git_parser = perceval.backends.git.Git(uri=upstream, gitpath=upstream)
-    from_date = datetime.datetime.strptime(args.after, '%Y-%m-%d')
+    from_date = datetime.datetime.strptime(after, '%Y-%m-%d')
     for item in git_parser.fetch(from_date = from_date):
         metrics.add_commit(item['data']['commit'], item['data']['CommitDate'])
     logging.info("%d commits parsed." % metrics.num_commits())
 
     left = 0
     right = metrics.num_commits()-1
-    step = args.step
-    while step >= 1:
-        metrics.compute_range (left, right, step)
-        (left, right, min_seq, min_value) = metrics.min_range(3, "total_lines")
-        logging.info("Step: %d, left: %d, right: %d, min. seq: %d, min. value: %d."
-                    % (step, left, right, min_seq, min_value))
-        step = step // 2
+    try:
+        while step >= 1:
+            metrics.compute_range (left, right, step)
+            (left, right, min_seq, min_value) = metrics.min_range(3, "total_lines")
+            logging.info("Step: %d, left: %d, right: %d, min. seq: %d, min. value: %d."
+                        % (step, left, right, min_seq, min_value))
+            step = step // 2
+    finally:
+        metrics.close()
     min_commit = metrics.get_commit(min_seq)
     most_similar = {
         'sequence': min_seq,
@@ -499,7 +758,9 @@ if __name__ == "__main__":
     else:
         dir = args.pkg
 
-    up_commit = find_upstream_commit (upstream=args.repo, dir=dir, after=args.after)
+    up_commit = find_upstream_commit (upstream=args.repo, dir=dir,
+                                    after=args.after, step=args.step,
+                                    jobs=args.jobs)
     print ("Most similar checkout: %d (diff: %d), date: %s, hash: %s." %
             (up_commit['sequence'], up_commit['diff'],
             up_commit['date'], up_commit['hash']))